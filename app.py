@@ -5,19 +5,21 @@ Simplified to fetch only CHAINE_UPDATE products, pick collier or bracelet prices
 and fixed staged upload (no extra headers on PUT).
 """
 
-import json
 import os
-import queue
-import tempfile
 import threading
 import time
 from collections import deque
-from pathlib import Path
-from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Iterator
 
+import orjson
 import requests
 from dotenv import load_dotenv
 from flask import Flask, Response, flash, redirect, render_template, request, url_for
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.serving import is_running_from_reloader
 
 # ─── CONFIG ───────────────────────────────────────────
@@ -37,177 +39,352 @@ HEADERS_GQL = {
 }
 SURCHARGE_FILE = "variant_prices.json"
 
+# ─── HTTP SESSIONS ───────────────────────────────────
+# Keep-alive sessions so GraphQL calls and status polls reuse one TLS connection.
+def _make_session(prefix: str, retry: Retry) -> requests.Session:
+    s = requests.Session()
+    s.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return s
+
+# Every GraphQL call is a POST and several start bulk operations. A 502/504 or a
+# read timeout can arrive after Shopify has acted, so only retry what is known
+# to be unprocessed: refused connections and 429 rate limiting.
+SESSION = _make_session(
+    f"https://{SHOP_DOMAIN}",
+    Retry(total=3, read=0, backoff_factor=0.5, status_forcelist=[429], allowed_methods=frozenset({"POST"})),
+)
+SESSION.headers.update(HEADERS_GQL)
+# Staged uploads and bulk results live on another origin and must not carry the Shopify headers.
+# Uploads are streamed from a generator that cannot be replayed, so only GETs are retried.
+STORAGE_SESSION = _make_session(
+    "https://",
+    Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], allowed_methods=frozenset({"GET"})),
+)
+# Background requests overlapped with local work
+_io_pool = ThreadPoolExecutor(max_workers=2)
+
 # ─── FLASK SETUP ─────────────────────────────────────
 app = Flask(__name__)
 app.secret_key = FLASK_SECRET
 
-log_buffer: deque[str] = deque(maxlen=200)
-_log_q: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+# Shopify runs one bulk mutation per shop at a time, so do the same with jobs
+JOB_POOL = ThreadPoolExecutor(max_workers=1)
+_current_job: Future | None = None
+_job_lock = threading.Lock()
+
+# One ring buffer serves both reconnect replay and live streaming; each SSE
+# client tracks the sequence number of the last frame it sent. Entries are
+# stored as ready-to-send SSE frames whose id is "<epoch>-<seq>", so
+# reconnecting browsers resume via Last-Event-ID; the per-process epoch
+# makes ids from before a restart unusable.
+log_buffer: deque[bytes] = deque(maxlen=200)
+_LOG_EPOCH = os.urandom(4).hex()
+_log_seq = 0
+_log_cond = threading.Condition()
+_last_ts_sec = 0
+_last_ts_str = ""
 
 def _log(msg: str):
-    line = f"[{time.strftime('%H:%M:%S')}] {msg}"
-    log_buffer.append(line)
-    _log_q.put_nowait(line)
+    global _log_seq, _last_ts_sec, _last_ts_str
+    with _log_cond:
+        now = int(time.time())
+        if now != _last_ts_sec:
+            _last_ts_str = time.strftime("%H:%M:%S", time.localtime(now))
+            _last_ts_sec = now
+        _log_seq += 1
+        log_buffer.append(f"id:{_LOG_EPOCH}-{_log_seq}\ndata:[{_last_ts_str}] {msg}\n\n".encode())
+        _log_cond.notify_all()
+
+def _log_since(seen: int, timeout: float | None = None) -> tuple[int, list[bytes]]:
+    """Wait until frames newer than `seen` exist; return the new seq and those frames (none on timeout)."""
+    with _log_cond:
+        if not _log_cond.wait_for(lambda: _log_seq > seen, timeout):
+            return seen, []
+        start = max(0, len(log_buffer) - (_log_seq - seen))
+        return _log_seq, list(islice(log_buffer, start, None))
 
 
 # ─── UTILS ────────────────────────────────────────────
+# Parsed surcharge table, keyed by the file's mtime. Callers must not mutate it.
+_prices_cache: tuple[int, dict[str, Any]] | None = None
+_prices_lock = threading.Lock()
+
 def load_prices() -> dict[str, Any]:
-    with open(SURCHARGE_FILE, "r", encoding="utf-8") as fh:
-        return json.load(fh)
+    global _prices_cache
+    with _prices_lock:
+        mtime = os.stat(SURCHARGE_FILE).st_mtime_ns
+        if _prices_cache and _prices_cache[0] == mtime:
+            return _prices_cache[1]
+        with open(SURCHARGE_FILE, "rb") as fh:
+            data = orjson.loads(fh.read())
+        _prices_cache = (mtime, data)
+        return data
 
 def save_prices(data: dict[str, Any]):
-    with open(SURCHARGE_FILE, "w", encoding="utf-8") as fh:
-        json.dump(data, fh, ensure_ascii=False, indent=2)
-
-def gql(query: str, variables: dict | None = None) -> dict[str, Any]:
-    r = requests.post(GRAPHQL_URL, headers=HEADERS_GQL, json={"query": query, "variables": variables or {}}, timeout=60)
+    global _prices_cache
+    with _prices_lock:
+        with open(SURCHARGE_FILE, "wb") as fh:
+            fh.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        _prices_cache = (os.stat(SURCHARGE_FILE).st_mtime_ns, data)
+
+@lru_cache(maxsize=None)
+def _body_prefix(query: str) -> bytes:
+    """JSON envelope up to `"variables":`; queries are module constants, so encode each once."""
+    return orjson.dumps({"query": query, "variables": None})[:-5]  # strip `null}`
+
+class Throttled(RuntimeError):
+    """Shopify refused a GraphQL call for lack of cost points (HTTP 200, code THROTTLED)."""
+    def __init__(self, errors: list, extensions: dict[str, Any]):
+        super().__init__(errors)
+        self.extensions = extensions
+
+def gql(query: str, variables: dict | None = None, with_extensions: bool = False) -> Any:
+    body = _body_prefix(query) + orjson.dumps(variables) + b"}"
+    r = SESSION.post(GRAPHQL_URL, data=body, timeout=60)
     r.raise_for_status()
-    j = r.json()
+    j = orjson.loads(r.content)
     if j.get("errors"):
+        if any(e.get("extensions", {}).get("code") == "THROTTLED" for e in j["errors"]):
+            raise Throttled(j["errors"], j.get("extensions", {}))
         raise RuntimeError(j["errors"])
+    if with_extensions:
+        return j["data"], j.get("extensions", {})
     return j["data"]
 
+def throttle_delay(extensions: dict[str, Any]) -> float:
+    """Seconds until the leaky bucket refills enough to afford the same query again."""
+    cost = extensions.get("cost")
+    if not cost:
+        return 1.0
+    throttle = cost["throttleStatus"]
+    missing = cost["requestedQueryCost"] - throttle["currentlyAvailable"]
+    return min(30.0, max(1.0, missing / throttle["restoreRate"]))
+
+
+# ─── BULK OPERATION HELPERS ──────────────────────────
+BULK_OP_QUERY = """
+query bulkOp($id: ID!) {
+  node(id: $id) { ... on BulkOperation { id status errorCode objectCount url } }
+}
+"""
+
+def wait_bulk_operation(op_id: str) -> dict:
+    """Poll bulk operation `op_id` until it reaches a final state."""
+    # back off exponentially, but never poll faster than the cost bucket refills
+    delay = 1.0
+    while True:
+        time.sleep(delay)
+        try:
+            data, ext = gql(BULK_OP_QUERY, {"id": op_id}, with_extensions=True)
+        except Throttled as e:
+            delay = throttle_delay(e.extensions)
+            _log(f"Bulk {op_id} → throttled, retrying in {delay:.0f}s")
+            continue
+        stat = data["node"]
+        if stat is None:
+            raise RuntimeError(f"Bulk operation {op_id} not found")
+        _log(f"Bulk {op_id} → {stat['status']}")
+        if stat["status"] in ("COMPLETED", "FAILED", "CANCELED", "EXPIRED"):
+            return stat
+        delay = min(30.0, max(throttle_delay(ext), delay * 1.5))
+
+BULK_QUERY_MUTATION = """
+mutation runQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+def iter_bulk_result(url: str) -> Iterator[dict]:
+    """Stream a bulk JSONL result, parsing rows as chunks arrive."""
+    with STORAGE_SESSION.get(url, stream=True, timeout=120) as r:
+        r.raise_for_status()
+        buf = b""
+        for chunk in r.iter_content(65536):
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if line:
+                    yield orjson.loads(line)
+        if buf.strip():
+            yield orjson.loads(buf)
+
+def run_bulk_query(query: str) -> Iterator[dict]:
+    """Run `query` as a bulk operation and iterate over its JSONL result rows."""
+    op = gql(BULK_QUERY_MUTATION, {"query": query})["bulkOperationRunQuery"]
+    if op["userErrors"]:
+        raise RuntimeError(op["userErrors"])
+    stat = wait_bulk_operation(op["bulkOperation"]["id"])
+    if stat["status"] != "COMPLETED":
+        raise RuntimeError(f"Bulk query failed: {stat}")
+    if not stat["url"]:  # no matching objects
+        return iter(())
+    return iter_bulk_result(stat["url"])
+
 
 # ─── FETCH CHAINE_UPDATE PRODUCTS ─────────────────────
-def fetch_products_graphql() -> list[dict]:
-    _log("Fetching products via GraphQL…")
-    products: list[dict] = []
-    cursor = None
-    graphql_query = """
-    query fetchProducts($cursor: String) {
-      products(first: 250, query: "tag:CHAINE_UPDATE", after: $cursor) {
-        pageInfo { hasNextPage endCursor }
-        edges { node {
-          id
-          tags
-          metafields(first: 10, namespace: "custom") {
-            edges { node { key value } }
-          }
-          variants(first: 100) {
-            edges { node { id title } }
-          }
-        }}
+PRODUCTS_BULK_QUERY = """
+{
+  products(query: "tag:CHAINE_UPDATE") {
+    edges { node {
+      id
+      tags
+      base_price: metafield(namespace: "custom", key: "base_price") { value }
+      variants {
+        edges { node { id title } }
       }
-    }
-    """
-    while True:
-        data = gql(graphql_query, {"cursor": cursor})["products"]
-        for edge in data["edges"]:
-            products.append(edge["node"])
-        if not data["pageInfo"]["hasNextPage"]:
-            break
-        cursor = data["pageInfo"]["endCursor"]
+    }}
+  }
+}
+"""
+
+def fetch_products_graphql() -> Iterator[dict]:
+    """Yield each CHAINE_UPDATE product with its variants as soon as it is complete."""
+    _log("Fetching products via GraphQL bulk query…")
+    count = 0
+    product: dict | None = None
+    # bulk JSONL is flat: children follow their product and point back via __parentId
+    for row in run_bulk_query(PRODUCTS_BULK_QUERY):
+        parent_id = row.pop("__parentId", None)
+        if parent_id is None:
+            if product is not None:
+                count += 1
+                yield product
+            row["variants"] = {"edges": []}
+            product = row
+        elif product is not None and parent_id == product["id"]:
+            product["variants"]["edges"].append({"node": row})
+        else:
+            raise RuntimeError(f"Bulk result row for {parent_id} not after its product")
+    if product is not None:
+        count += 1
+        yield product
 
-    _log(f"Fetched {len(products)} products via GraphQL")
-    return products
+    _log(f"Fetched {count} products via GraphQL")
 
 
 # ─── BULK MUTATION HELPERS ────────────────────────────
-BULK_MUTATION = r"""
-mutation bulk($stagedUploadPath: String!) {
-  bulkOperationRunMutation(
-    mutation: \"""" + r"""
-mutation call($input: ProductVariantInput!) {
-  productVariantUpdate(input: $input) { userErrors { field message } }
+# Up to 100 variants of one product are updated per JSONL row
+VARIANTS_UPDATE_MUTATION = """
+mutation call($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+  productVariantsBulkUpdate(productId: $productId, variants: $variants) { userErrors { field message } }
 }
-""" + r"""\""",
-    stagedUploadPath: $stagedUploadPath
-  ) { bulkOperation { id status } userErrors { field message } }
+"""
+VARIANTS_PER_ROW = 100
+JSONL_CHUNK_ROWS = 500  # rows per chunk of the streamed upload body
+
+BULK_MUTATION = """
+mutation bulk($mutation: String!, $stagedUploadPath: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $stagedUploadPath) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
 }
 """
 
-def staged_upload(jsonl_path: Path) -> str:
-    resp = gql(
-        """
-    mutation($input:[StagedUploadInput!]!){
-      stagedUploadsCreate(input:$input){
-        stagedTargets {
-          url
-          resourceUrl
-          parameters { name value }
-        }
-        userErrors { field message }
-      }
+STAGED_UPLOAD_MUTATION = """
+mutation($input:[StagedUploadInput!]!){
+  stagedUploadsCreate(input:$input){
+    stagedTargets {
+      url
+      resourceUrl
+      parameters { name value }
     }
-    """,
+    userErrors { field message }
+  }
+}
+"""
+
+def create_staged_target(filename: str) -> dict:
+    resp = gql(
+        STAGED_UPLOAD_MUTATION,
         {"input": [{
             "resource": "BULK_MUTATION_VARIABLES",
-            "filename": jsonl_path.name,
+            "filename": filename,
             "mimeType": "text/jsonl",
             "httpMethod": "PUT",
         }]},
     )["stagedUploadsCreate"]
     if resp["userErrors"]:
         raise RuntimeError(resp["userErrors"])
-
-    tgt = resp["stagedTargets"][0]
-    # Do NOT send extra headers; only the signed params are allowed
-    with open(jsonl_path, "rb") as fh:
-        requests.put(tgt["url"], params={p["name"]: p["value"] for p in tgt["parameters"]}, data=fh, timeout=120).raise_for_status()
+    return resp["stagedTargets"][0]
+
+def _jsonl_rows(variant_map: dict[str, dict[str, str]]) -> Iterator[dict]:
+    for product_id, prices in variant_map.items():
+        variants = [{"id": vid, "price": price} for vid, price in prices.items()]
+        for i in range(0, len(variants), VARIANTS_PER_ROW):
+            yield {"productId": product_id, "variants": variants[i:i + VARIANTS_PER_ROW]}
+
+def jsonl_stream(variant_map: dict[str, dict[str, str]]) -> Iterator[bytes]:
+    """Yield the JSONL payload in chunks of JSONL_CHUNK_ROWS rows, one join per chunk."""
+    rows = _jsonl_rows(variant_map)
+    while batch := list(islice(rows, JSONL_CHUNK_ROWS)):
+        yield b"\n".join([orjson.dumps(row) for row in batch]) + b"\n"
+
+def staged_upload(tgt: dict, payload: Iterator[bytes]) -> str:
+    # Do NOT send extra headers; only the signed params are allowed.
+    # A generator body is sent with chunked transfer encoding, which the storage host accepts.
+    STORAGE_SESSION.put(tgt["url"], params={p["name"]: p["value"] for p in tgt["parameters"]}, data=payload, timeout=120).raise_for_status()
     return tgt["resourceUrl"]
 
-def bulk_update(variant_map: dict[str, float]):
-    _log(f"Preparing {len(variant_map)} variants…")
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jsonl") as tmp:
-        for vid, price in variant_map.items():
-            tmp.write(json.dumps({"input": {"id": vid, "price": str(price)}}).encode() + b"\n")
-        tmp_path = Path(tmp.name)
-
-    res_url = staged_upload(tmp_path)
+def bulk_update(variant_map: dict[str, dict[str, str]], tgt: dict):
+    n_variants = sum(len(prices) for prices in variant_map.values())
+    _log(f"Preparing {n_variants} variants across {len(variant_map)} products…")
+    # rows are encoded while the upload is in flight, never held in memory at once
+    res_url = staged_upload(tgt, jsonl_stream(variant_map))
     _log("JSONL uploaded, launching bulk mutation…")
 
-    op = gql(BULK_MUTATION, {"stagedUploadPath": res_url})["bulkOperationRunMutation"]
+    op = gql(BULK_MUTATION, {"mutation": VARIANTS_UPDATE_MUTATION, "stagedUploadPath": res_url})["bulkOperationRunMutation"]
     if op["userErrors"]:
         raise RuntimeError(op["userErrors"])
-    op_id = op["bulkOperation"]["id"]
-
-    while True:
-        stat = gql("{ currentBulkOperation { status objectCount } }")["currentBulkOperation"]
-        _log(f"Bulk {op_id} → {stat['status']}")
-        if stat["status"] in ("COMPLETED", "FAILED", "CANCELED"):
-            break
-        time.sleep(4)
+    stat = wait_bulk_operation(op["bulkOperation"]["id"])
 
     if stat["status"] == "COMPLETED":
-        _log(f"✅ Completed — {stat['objectCount']} variants.")
+        _log(f"✅ Completed — {n_variants} variants across {len(variant_map)} products ({stat['objectCount']} rows).")
     else:
         _log(f"💥 Bulk failed: {stat}")
 
 
 # ─── WORKER ──────────────────────────────────────────
+# Surcharge category per product tag, in priority order (collier wins over bracelet)
+CATEGORY_TAGS = ("collier", "bracelet")
+
 def worker():
     try:
-        products = fetch_products_graphql()
+        # reserve the upload target while products are fetched and priced
+        tgt_future = _io_pool.submit(create_staged_target, "variants.jsonl")
         prices = load_prices()
-        variant_map: dict[str, float] = {}
-
-        for p in products:
-            # if collier tag → use collier prices, elif bracelet → bracelet
-            if "collier" in p["tags"]:
-                cat = "collier"
-            elif "bracelet" in p["tags"]:
-                cat = "bracelet"
-            else:
+        variant_map: dict[str, dict[str, str]] = {}  # product id → variant id → price
+        # surcharge lookup per category: stripped titles → cents
+        lut = {cat: {k.strip(): round(float(v) * 100) for k, v in rows.items()} for cat, rows in prices.items()}
+
+        for p in fetch_products_graphql():
+            tagset = frozenset(p["tags"])
+            cat = next((t for t in CATEGORY_TAGS if t in tagset), None)
+            if cat is None:
                 continue
+            lut_cat = lut.get(cat, {})
 
-            # find base_price metafield
-            base = None
-            for mf in p["metafields"]["edges"]:
-                if mf["node"]["key"] == "base_price":
-                    base = float(mf["node"]["value"])
-                    break
-            if base is None:
+            if not p["base_price"]:
                 continue
+            base_cents = round(float(p["base_price"]["value"]) * 100)
 
             # build variant→new price
+            product_prices: dict[str, str] = {}
             for v in p["variants"]["edges"]:
                 vid = v["node"]["id"]
-                title = v["node"]["title"].strip()
-                surcharge = float(prices.get(cat, {}).get(title, 0))
-                variant_map[vid] = round(base + surcharge, 2)
+                c = base_cents + lut_cat.get(v["node"]["title"].strip(), 0)
+                if c < 0:  # Shopify rejects negative prices; also keeps the formatting below valid
+                    _log(f"⚠️ Skipping {vid}: negative price ({c / 100:.2f})")
+                    continue
+                product_prices[vid] = f"{c // 100}.{c % 100:02d}"
+            if product_prices:
+                variant_map[p["id"]] = product_prices
 
         if variant_map:
-            bulk_update(variant_map)
+            bulk_update(variant_map, tgt_future.result())
         else:
             _log("Nothing to update.")
     except Exception as e:
@@ -221,17 +398,24 @@ def ping():
 
 @app.route("/stream")
 def stream():
+    epoch, _, seq = request.headers.get("Last-Event-ID", "").partition("-")
+    last_id = int(seq) if epoch == _LOG_EPOCH and seq.isdigit() else 0
+
     def gen():
-        for line in list(log_buffer):
-            yield f"data:{line}\n\n"
+        seen = last_id
         while True:
-            yield f"data:{_log_q.get()}\n\n"
+            seen, frames = _log_since(seen, timeout=15.0)
+            if frames:
+                yield from frames
+            else:
+                yield b": ping\n\n"  # SSE comment; lets the server notice closed clients
     return Response(gen(), mimetype="text/event-stream")
 
 @app.route("/", methods=["GET","POST"])
 def prices():
     data = load_prices()
     if request.method == "POST":
+        data = {cat: dict(rows) for cat, rows in data.items()}  # leave the cached table untouched
         for cat in data:
             for name in data[cat]:
                 key = f"{cat}_{name}"
@@ -243,8 +427,16 @@ def prices():
 
 @app.post("/update")
 def update():
-    _log("👋 /update called – launching worker")
-    threading.Thread(target=worker, daemon=True).start()
+    global _current_job
+    # check-and-submit must be atomic: _log() can yield to another request under gevent
+    with _job_lock:
+        busy = _current_job is not None and not _current_job.done()
+        if not busy:
+            _log("👋 /update called – launching worker")
+            _current_job = JOB_POOL.submit(worker)
+    if busy:
+        _log("👋 /update called – a job is already running")
+        return "Bulk update already running — watch logs", 409
     flash("Bulk update started — watch logs", "info")
     return redirect(url_for("prices"))
 
@@ -5,13 +5,30 @@ setInterval(() => fetch("/__ping").catch(() => { }), 15000);
 // show toasts
 document.querySelectorAll(".toast").forEach(t => new bootstrap.Toast(t).show());
 
+// same markup as the flashed toasts in base.html
+function showToast(msg, cat) {
+    const t = document.createElement("div");
+    t.className = `toast text-bg-${cat}`;
+    t.setAttribute("role", "alert");
+    t.dataset.bsDelay = "5000";
+    t.innerHTML = '<div class="d-flex"><div class="toast-body"></div>' +
+        '<button type="button" class="btn-close btn-close-white me-2 m-auto" data-bs-dismiss="toast"></button></div>';
+    t.querySelector(".toast-body").textContent = msg;
+    document.querySelector("main").prepend(t);
+    new bootstrap.Toast(t).show();
+}
+
 // wire Update button
 console.log("✅ script.js has been loaded and is executing");
 document.getElementById("run")?.addEventListener("click", () => {
     console.log("🔔 Update button clicked");
-    fetch("/update", { method: "POST" })
-        .then(resp => console.log("🔄 /update response status:", resp.status))
-        .then(() => location.reload())
+    // don't follow the redirect: that would consume the flash before the reload shows it
+    fetch("/update", { method: "POST", redirect: "manual" })
+        .then(async resp => {
+            console.log("🔄 /update response status:", resp.status);
+            if (resp.status === 409) showToast(await resp.text(), "warning");
+            else location.reload();
+        })
         .catch(err => console.error("🚨 Fetch error:", err));
 });
 